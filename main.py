@@ -4,13 +4,26 @@ import argparse
 import logging
 import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
 
-location_url = lambda parent_id: f"https://drive.google.com/drive/folders/{parent_id}"
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+
+# Map tab and newline delimiters to spaces for Sheets pasteData
+# Output is pasted as tab delimited text, so any tabs or newlines in file names,
+# folder paths or display names are written to the sheet as spaces
+PASTE_DELIMITERS = str.maketrans("\t\r\n", "   ")
+
+# Maximum rows pasted per Sheets request
+PASTE_CHUNK_ROWS = 10000
+
+LOCATION_URL = "https://drive.google.com/drive/folders/"
 
 
 def main(
@@ -36,26 +49,92 @@ def main(
     kwargs = {
         "corpora": "drive",
         "driveId": drive_id,
-        "fields": "files(id, mimeType, name, createdTime, modifiedTime, lastModifyingUser(displayName), trashedTime, webViewLink, parents), nextPageToken",
         "includeItemsFromAllDrives": True,
         "pageSize": 1000,
         "supportsAllDrives": True,
-        "q": "trashed = false",
     }
 
+    # Only request fields that are output to the sheet
+    file_fields = "id, name, parents, webViewLink, createdTime, modifiedTime, lastModifyingUser(displayName)"
     if list_trashed:
-        del kwargs["q"]
+        file_fields += ", trashedTime"
+
+    # Folders only need enough to resolve paths unless they are also listed
+    folder_fields = file_fields if list_folders else "id, name, parents"
+
+    # Page tokens are sequential, so split the search into independent
+    # folder and non-folder queries and paginate both concurrently
+    queries = [
+        (f"mimeType = '{FOLDER_MIME_TYPE}'", folder_fields),
+        (f"mimeType != '{FOLDER_MIME_TYPE}'", file_fields),
+    ]
+    if not list_trashed:
+        queries = [
+            (f"{query} and trashed = false", fields) for query, fields in queries
+        ]
+
+    folder_search, file_search = [
+        {**kwargs, "q": query, "fields": f"files({fields}), nextPageToken"}
+        for query, fields in queries
+    ]
+
+    # Pages are consumed on the worker threads, so folders are indexed as they
+    # arrive rather than in a second pass once listing is complete
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        folder_index = executor.submit(
+            index_folders,
+            list_files(drive_service, credentials, folder_search),
+            list_folders,
+        )
+        file_list = executor.submit(
+            list, list_files(drive_service, credentials, file_search)
+        )
+
+        # Without --sheet, output goes to the first sheet, so look up its ID
+        # while files are listed rather than as a separate round trip after
+        if not sheet_output:
+            first_sheet = executor.submit(
+                get_first_sheet, sheets_service, spreadsheet_id
+            )
+
+    folder_dict, folders = folder_index.result()
+    files = file_list.result()
+
+    logging.info(f"Found {len(folder_dict) + len(files)} total files")
 
-    # Recursively find all files in drive
-    files = []
+    # Folders are always needed to resolve paths, but only output if requested
+    if list_folders:
+        files = folders + files
+
+    root_folder_name = get_folder_name(folder_dict, rootFolder)
+    if sheet_output:
+        sheet = create_sheet(
+            drive_service, sheets_service, drive_id, spreadsheet_id, root_folder_name
+        )
+    else:
+        sheet = first_sheet.result()
+    rows = build_sheet_body(files, folder_dict, root_folder_name)
+    output_to_sheet(sheets_service, spreadsheet_id, rows, sheet)
+
+
+def authorized_http(credentials):
+    # httplib2 is not thread safe, so each thread needs its own connection
+    return AuthorizedHttp(credentials, http=build_http())
+
+
+def list_files(drive_service, credentials, kwargs):
+    # Reuse one keep-alive connection for every page of this query
+    http = authorized_http(credentials)
+
+    # Recursively find all files matching query, yielding each page as it arrives
     while True:
         try:
-            results = drive_service.files().list(**kwargs).execute()
+            results = drive_service.files().list(**kwargs).execute(http=http)
         except HttpError as e:
             logging.error(e)
             raise
 
-        files.extend(results["files"])
+        yield from results["files"]
 
         # If no next page, break out of loop
         if "nextPageToken" not in results:
@@ -64,39 +143,26 @@ def main(
         # Add next page token to kwargs
         kwargs["pageToken"] = results["nextPageToken"]
 
-    logging.info(f"Found {len(files)} total files")
-
-    for file in files:
-        file["path"] = build_file_path(files, file["parents"][0])
-        file["location"] = location_url(file["parents"][0])
-        if file["path"] == "":
-            file["path"] = "/"
 
-        if "lastModifyingUser" in file:
-            file["lastModifyingUser"] = file.pop("lastModifyingUser")["displayName"]
+def index_folders(folders, list_folders):
+    # Index folder name and parent ID by folder ID to resolve paths
+    # Full folder records are only kept if folders are being listed
+    folder_dict = {}
+    listed_folders = []
+    for folder in folders:
+        folder_dict[folder["id"]] = (folder["name"], folder["parents"][0])
+        if list_folders:
+            listed_folders.append(folder)
 
-        if file["mimeType"] != "application/vnd.google-apps.folder":
-            file["nameFailedCheck"] = validate_file_name(file)
-        else:
-            file["nameFailedCheck"] = ""
-
-    sheet_name = None
-    root_folder_name = get_folder_name(files, rootFolder)
-    if sheet_output:
-        sheet_name = create_sheet(
-            drive_service, sheets_service, drive_id, spreadsheet_id, root_folder_name
-        )
-    body = build_sheet_body(files, list_folders, root_folder_name)
-    output_to_sheet(sheets_service, spreadsheet_id, body, sheet_name)
+    return folder_dict, listed_folders
 
 
-def validate_file_name(file):
+def validate_file_name(name):
     special_characters = '^*<>/\|}{~:?"'
     # Pattern matches string with only digits and/or special characters we allow.
     # Some special chars need to be escaped because regex
     regex_pattern = f"^[0-9\.@$\(\)\[\]%&\-_]+$"
     failures = []
-    name = file["name"]
 
     # List of dicts to store validation conditions
     conditions = [
@@ -125,35 +191,53 @@ def validate_file_name(file):
     return failure_string
 
 
-def get_folder_name(files, folder_id):
-    file_dict = {file["id"]: file for file in files}
-    folder = file_dict.get(folder_id)
-
-    return folder["name"] if folder is not None else None
+def get_folder_name(folder_dict, folder_id):
+    folder = folder_dict.get(folder_id)
 
+    return folder[0] if folder is not None else None
 
-def build_file_path(files, parent_id, path="", file_dict=None):
-    if file_dict is None:
-        # Create a dictionary to store the files by their IDs
-        file_dict = {file["id"]: file for file in files}
 
-    parent_folder = file_dict.get(parent_id)
-    if parent_folder is None:
+def build_file_path(folder_dict, parent_id, cache):
+    # Fast path: parent folder already resolved
+    path = cache.get(parent_id)
+    if path is not None:
         return path
 
-    path = f"{parent_folder['name']}/{path}"
+    # Walk up until we reach the root or a folder with a cached path
+    stack = []
+    while parent_id not in cache:
+        folder = folder_dict.get(parent_id)
+        if folder is None:
+            break
+        stack.append((parent_id, folder[0]))
+        parent_id = folder[1]
+
+    path = cache.get(parent_id, "")
 
-    return build_file_path(files, parent_folder["parents"][0], path, file_dict)
+    # Unwind back down, caching the path of each folder along the way
+    for folder_id, name in reversed(stack):
+        path = f"{path}{name}/"
+        cache[folder_id] = path
+
+    return path
 
 
 def create_sheet(
     drive_service, sheets_service, drive_id, spreadsheet_id, root_folder_name
 ):
-    try:
-        drive = drive_service.drives().get(driveId=drive_id).execute()
-        spreadsheet = (
-            sheets_service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
+    # Drive and spreadsheet lookups are independent, so run them concurrently
+    # Each service has its own connection, so they can be used across threads
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        drive_future = executor.submit(
+            drive_service.drives().get(driveId=drive_id).execute
         )
+        spreadsheet_future = executor.submit(
+            sheets_service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute
+        )
+
+    try:
+        drive = drive_future.result()
+        spreadsheet = spreadsheet_future.result()
     except HttpError as e:
         logging.error(e)
         raise
@@ -161,36 +245,45 @@ def create_sheet(
     drive_name = drive["name"]
     if root_folder_name:
         drive_name += f"/{root_folder_name}"
-    sheets = spreadsheet["sheets"]
-    sheet_names = [sheet["properties"]["title"] for sheet in sheets]
 
-    if drive_name not in sheet_names:
-        request = {"addSheet": {"properties": {"title": drive_name}}}
-        try:
-            sheets_service.spreadsheets().batchUpdate(
-                spreadsheetId=spreadsheet_id, body={"requests": [request]}
-            ).execute()
-        except HttpError as e:
-            logging.error(e)
-            raise
+    # Return existing sheet properties so its sheetId can be reused
+    for sheet in spreadsheet["sheets"]:
+        if sheet["properties"]["title"] == drive_name:
+            return sheet["properties"]
 
-    return drive_name
+    request = {"addSheet": {"properties": {"title": drive_name}}}
+    try:
+        result = (
+            sheets_service.spreadsheets()
+            .batchUpdate(spreadsheetId=spreadsheet_id, body={"requests": [request]})
+            .execute()
+        )
+    except HttpError as e:
+        logging.error(e)
+        raise
 
+    return result["replies"][0]["addSheet"]["properties"]
 
-def build_sheet_body(files, list_folders, root_folder_name):
-    # Use pandas to build values for sheet (instead of manually formatting)
-    df = pd.DataFrame(files)
 
-    if root_folder_name is not None:
-        df = df.loc[df["path"].str.startswith(root_folder_name)]
+def get_first_sheet(sheets_service, spreadsheet_id):
+    try:
+        spreadsheet = (
+            sheets_service.spreadsheets()
+            .get(spreadsheetId=spreadsheet_id, fields="sheets.properties")
+            .execute()
+        )
+    except HttpError as e:
+        logging.error(e)
+        raise
 
-    # Build hyperlinks for name and path
-    df["name"] = '=HYPERLINK("' + df["webViewLink"] + '", "' + df["name"] + '")'
-    df["path"] = '=HYPERLINK("' + df["location"] + '", "' + df["path"] + '")'
+    # A range without a sheet name refers to the first visible sheet, so skip
+    # hidden sheets (a spreadsheet always has at least one visible sheet)
+    for sheet in spreadsheet["sheets"]:
+        if not sheet["properties"].get("hidden"):
+            return sheet["properties"]
 
-    if not list_folders:
-        df = df[~df["mimeType"].str.contains("folder", case=False)]
 
+def build_sheet_body(files, folder_dict, root_folder_name):
     col_order = [
         "name",
         "createdTime",
@@ -201,57 +294,127 @@ def build_sheet_body(files, list_folders, root_folder_name):
     ]
     time_cols = ["createdTime", "modifiedTime"]
 
+    # Drive only has folders and they are not being listed, so only write the header
+    if not files:
+        return ["\t".join(col_order)]
+
+    # Use pandas to build values for sheet (instead of manually formatting)
+    df = pd.DataFrame(files)
+
     if "trashedTime" in df:
         col_order.append("trashedTime")
         time_cols.append("trashedTime")
 
-    for time_col in time_cols:
-        df[time_col] = pd.to_datetime(df[time_col]).dt.strftime("%Y-%m-%d %H:%M:%S")
+    # Resolve paths once per file, caching folder paths as they are resolved
+    parent_ids = df["parents"].str[0]
+    folder_path_cache = {}
+    df["path"] = [
+        build_file_path(folder_dict, parent_id, folder_path_cache) or "/"
+        for parent_id in parent_ids.to_numpy()
+    ]
 
-    df = df[col_order]
-    df = df.fillna("")
+    if root_folder_name is not None:
+        keep = df["path"].str.startswith(root_folder_name)
+        df = df.loc[keep]
+        parent_ids = parent_ids.loc[keep]
+
+    # Nothing under the root folder, so only write the header
+    if df.empty:
+        return ["\t".join(col_order)]
+
+    df["location"] = LOCATION_URL + parent_ids
+
+    # Drive omits lastModifyingUser for some files, so it may be missing entirely
+    # Missing users are left empty here and filled with "" after extraction
+    if "lastModifyingUser" not in df:
+        df["lastModifyingUser"] = None
+
+    # Tabs and newlines delimit the pasted data, so free text is stripped of them
+    # while it is extracted rather than in separate passes
+    df["lastModifyingUser"] = (
+        df["lastModifyingUser"]
+        .map(
+            lambda user: user["displayName"].translate(PASTE_DELIMITERS),
+            na_action="ignore",
+        )
+        .fillna("")
+    )
 
-    values = [df.keys().tolist()]
-    values.extend(df.values.tolist())
+    # Folders are not subject to naming checks
+    df["nameFailedCheck"] = [
+        "" if file_id in folder_dict else validate_file_name(name)
+        for file_id, name in zip(df["id"].to_numpy(), df["name"].to_numpy())
+    ]
 
-    # Write new data to sheet
-    body = {"values": values}
+    # Build hyperlinks for name and path
+    df["name"] = build_hyperlinks(df["webViewLink"], df["name"])
+    df["path"] = build_hyperlinks(df["location"], df["path"])
 
-    return body
+    if "trashedTime" in df:
+        # Only trashed files have a trashed time
+        df["trashedTime"] = df["trashedTime"].fillna("")
 
+    # Drive returns RFC 3339 UTC timestamps, so reformat by slicing the string
+    # e.g. 2024-01-02T03:04:05.000Z -> 2024-01-02 03:04:05
+    for time_col in time_cols:
+        df[time_col] = df[time_col].str.slice(0, 19).str.replace("T", " ", regex=False)
 
-def output_to_sheet(sheets_service, spreadsheet_id, body, sheet_name):
-    range = "A:ZZ"
-    if sheet_name is not None:
-        range = f"'{sheet_name}'!{range}"
+    # Join columns straight into tab delimited rows for pasting into the sheet
+    rows = ["\t".join(col_order)]
+    rows += ["\t".join(row) for row in df[col_order].to_numpy(dtype=object).tolist()]
 
-    try:
-        sheets_service.spreadsheets().values().clear(
-            spreadsheetId=spreadsheet_id, range=range
-        ).execute()
-        logging.info(f"Cleared sheet {spreadsheet_id}")
-    except HttpError as e:
-        logging.error(e)
-        raise
+    return rows
 
-    try:
-        result = (
-            sheets_service.spreadsheets()
-            .values()
-            .update(
-                spreadsheetId=spreadsheet_id,
-                valueInputOption="USER_ENTERED",
-                range=range,
-                body=body,
-            )
-            .execute()
-        )
-        logging.info(
-            f"Written {result.get('updatedCells')} cells to sheet {spreadsheet_id}"
+
+def build_hyperlinks(urls, labels):
+    # Format on the raw arrays in one pass rather than chaining Series additions
+    # Double quotes in labels are escaped by doubling them inside the formula,
+    # and paste delimiters are stripped in the same pass
+    return [
+        '=HYPERLINK("%s", "%s")'
+        % (url, label.replace('"', '""').translate(PASTE_DELIMITERS))
+        for url, label in zip(urls.to_numpy(), labels.to_numpy())
+    ]
+
+
+def output_to_sheet(sheets_service, spreadsheet_id, rows, sheet):
+    # Clear existing values in the same request as the first chunk of rows
+    requests = [
+        {
+            "updateCells": {
+                "range": {"sheetId": sheet["sheetId"]},
+                "fields": "userEnteredValue",
+            }
+        }
+    ]
+
+    # Paste rows in chunks to keep each request within Sheets payload limits
+    # Chunks are written in order, since concurrent writes to a sheet can conflict
+    for start in range(0, len(rows), PASTE_CHUNK_ROWS):
+        requests.append(
+            {
+                "pasteData": {
+                    "coordinate": {"sheetId": sheet["sheetId"], "rowIndex": start},
+                    "data": "\n".join(rows[start : start + PASTE_CHUNK_ROWS]),
+                    "delimiter": "\t",
+                    "type": "PASTE_NORMAL",
+                }
+            }
         )
-    except HttpError as e:
-        logging.error(e)
-        raise
+
+        try:
+            sheets_service.spreadsheets().batchUpdate(
+                spreadsheetId=spreadsheet_id, body={"requests": requests}
+            ).execute()
+        except HttpError as e:
+            logging.error(e)
+            raise
+
+        requests = []
+
+    logging.info(
+        f"Written {len(rows) - 1} rows to sheet {sheet['title']} in {spreadsheet_id}"
+    )
 
 
 if __name__ == "__main__":